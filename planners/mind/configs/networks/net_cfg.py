@@ -23,6 +23,8 @@ class NetCfg():
         net_cfg["update_edge"] = True
 
         net_cfg["param_out"] = 'bezier'
+        net_cfg["use_amp"] = False  # bf16 autocast + TF32 for the network forward
+        net_cfg["use_compile"] = False  # torch.compile the sub-networks, keep eager for debugging
 
         net_cfg.update(self.g_cfg)  # append global config
         return net_cfg
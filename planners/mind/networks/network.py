@@ -5,7 +5,7 @@ from torch import Tensor, nn
 from torch.nn import functional as F
 from torch.nn import MultiheadAttention, TransformerEncoderLayer, TransformerEncoder
 from typing import Dict, List, Tuple, Optional
-from planners.mind.utils import gpu
+from planners.mind.utils import gpu, gpu_cat
 from planners.mind.networks.layers import Conv1d, Res1d
 
 
@@ -16,6 +16,8 @@ class ActorNet(nn.Module):
 
     def __init__(self, n_in=3, hidden_size=128, n_fpn_scale=4):
         super(ActorNet, self).__init__()
+        # (N, C, T) layout is kept: torch has no channels-last format for 3d tensors, and GN(ng=1) over (C, T)
+        # is what the checkpoints were trained with (not interchangeable with a per-step LayerNorm)
         norm = "GN"
         ng = 1
 
@@ -52,6 +54,8 @@ class ActorNet(nn.Module):
             out = self.groups[i](out)
             outputs.append(out)
 
+        # the full top-down map is needed even though only the last step is returned: the GroupNorm (ng=1) in
+        # lateral/output normalizes over the whole time axis, and the weights are trained with linear upsampling
         out = self.lateral[-1](outputs[-1])
         for i in range(len(outputs) - 2, -1, -1):
             out = F.interpolate(out, scale_factor=2, mode="linear", align_corners=False)
@@ -85,16 +89,20 @@ class PointAggregateBlock(nn.Module):
         self.norm = nn.LayerNorm(hidden_size)
 
     def _global_maxpool_aggre(self, feat):
-        return F.adaptive_max_pool1d(feat.permute(0, 2, 1), 1).permute(0, 2, 1)
+        return feat.amax(dim=1, keepdim=True)
 
     def forward(self, x_inp):
         x = self.fc1(x_inp)  # [N_{lane}, 10, hidden_size]
-        x_aggre = self._global_maxpool_aggre(x)
-        x_aggre = torch.cat([x, x_aggre.repeat([1, x.shape[1], 1])], dim=-1)
-
-        out = self.norm(x_inp + self.fc2(x_aggre))
+        x_aggre = self._global_maxpool_aggre(x)  # [N_{lane}, 1, hidden_size]
+        # fc2(cat([x, x_aggre.repeat(...)])) with the first linear split per input half,
+        # the aggregated feature is projected once and broadcast over the points
+        fc = self.fc2[0]
+        w_x, w_aggre = fc.weight.chunk(2, dim=1)
+        x_aggre = F.linear(x, w_x, fc.bias) + F.linear(x_aggre, w_aggre)
+
+        out = self.norm(x_inp + self.fc2[1:](x_aggre))
         if self.aggre_out:
-            return self._global_maxpool_aggre(out).squeeze()
+            return self._global_maxpool_aggre(out).squeeze(1)
         else:
             return out
 
@@ -129,10 +137,13 @@ class RelaFusionLayer(nn.Module):
                  d_ffn: int = 2048,
                  n_head: int = 8,
                  dropout: float = 0.1,
-                 update_edge: bool = True) -> None:
+                 update_edge: bool = True,
+                 use_compile: bool = False) -> None:
         super(RelaFusionLayer, self).__init__()
         self.device = device
         self.update_edge = update_edge
+        self.n_head = n_head
+        self.dropout_p = dropout
 
         self.proj_memory = nn.Sequential(
             nn.Linear(d_model + d_model + d_edge, d_model),
@@ -148,6 +159,7 @@ class RelaFusionLayer(nn.Module):
             )
             self.norm_edge = nn.LayerNorm(d_edge)
 
+        # only holds the in/out projection weights, attention is computed by F.scaled_dot_product_attention
         self.multihead_attn = MultiheadAttention(
             embed_dim=d_model, num_heads=n_head, dropout=dropout, batch_first=False)
 
@@ -162,20 +174,24 @@ class RelaFusionLayer(nn.Module):
         self.dropout3 = nn.Dropout(dropout)
         self.activation = nn.ReLU(inplace=True)
 
+        if use_compile:
+            # let inductor fuse the residual-add + LayerNorm (+ ReLU) sequences, B and N vary per batch
+            self.forward = torch.compile(self.forward, dynamic=True)
+
     def forward(self,
                 node: Tensor,
                 edge: Tensor,
                 edge_mask: Optional[Tensor]) -> Tensor:
         '''
             input:
-                node:       (N, d_model)
-                edge:       (N, N, d_model)
-                edge_mask:  (N, N)
+                node:       (B, N, d_model)
+                edge:       (B, N, N, d_edge)
+                edge_mask:  (B, N), True for padded tokens
         '''
         # update node
         x, edge, memory = self._build_memory(node, edge)
         x_prime, _ = self._mha_block(x, memory, attn_mask=None, key_padding_mask=edge_mask)
-        x = self.norm2(x + x_prime).squeeze()
+        x = self.norm2(x + x_prime)
         x = self.norm3(x + self._ff_block(x))
         return x, edge, None
 
@@ -184,24 +200,30 @@ class RelaFusionLayer(nn.Module):
                       edge: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
         '''
             input:
-                node:   (N, d_model)
-                edge:   (N, N, d_edge)
+                node:   (B, N, d_model)
+                edge:   (B, N, N, d_edge)
             output:
-                :param  (1, N, d_model)
-                :param  (N, N, d_edge)
-                :param  (N, N, d_model)
+                :param  (B, N, d_model)
+                :param  (B, N, N, d_edge)
+                :param  (B, N, N, d_model)
         '''
-        n_token = node.shape[0]
+        d_edge = edge.shape[-1]
+        d_model = node.shape[-1]
 
         # 1. build memory
-        src_x = node.unsqueeze(dim=0).repeat([n_token, 1, 1])  # (N, N, d_model)
-        tar_x = node.unsqueeze(dim=1).repeat([1, n_token, 1])  # (N, N, d_model)
-        memory = self.proj_memory(torch.cat([edge, src_x, tar_x], dim=-1))  # (N, N, d_model)
+        # proj_memory(cat([edge, src_x, tar_x])) with the first linear split per input slice, so that
+        # the node terms are projected once and broadcast instead of repeating them to (B, N, N, d_model)
+        fc = self.proj_memory[0]
+        w_e, w_s, w_t = fc.weight.split([d_edge, d_model, d_model], dim=1)
+        src_x = F.linear(node, w_s).unsqueeze(dim=1)  # (B, 1, N, d_model)
+        tar_x = F.linear(node, w_t).unsqueeze(dim=2)  # (B, N, 1, d_model)
+        memory = F.linear(edge, w_e, fc.bias) + src_x + tar_x  # (B, N, N, d_model)
+        memory = self.proj_memory[1:](memory)
         # 2. (optional) update edge (with residual)
         if self.update_edge:
-            edge = self.norm_edge(edge + self.proj_edge(memory))  # (N, N, d_edge)
+            edge = self.norm_edge(edge + self.proj_edge(memory))  # (B, N, N, d_edge)
 
-        return node.unsqueeze(dim=0), edge, memory
+        return node, edge, memory
 
     # multihead attention block
     def _mha_block(self,
@@ -211,18 +233,45 @@ class RelaFusionLayer(nn.Module):
                    key_padding_mask: Optional[Tensor]) -> Tensor:
         '''
             input:
-                x:                  [1, N, d_model]
-                mem:                [N, N, d_model]
+                x:                  [B, N, d_model]
+                mem:                [B, N, N, d_model]
                 attn_mask:          [N, N]
-                key_padding_mask:   [N, N]
+                key_padding_mask:   [B, N]
             output:
-                :param      [1, N, d_model]
+                :param      [B, N, d_model]
                 :param      [N, N]
         '''
-        x, _ = self.multihead_attn(x, mem, mem,
-                                   attn_mask=attn_mask,
-                                   key_padding_mask=key_padding_mask,
-                                   need_weights=False)  # return average attention weights
+        n_batch, n_token, d_model = x.shape
+        n_key = mem.shape[1]
+        d_head = d_model // self.n_head
+
+        # k and v share the same input, project them with one packed GEMM
+        w_q, w_kv = self.multihead_attn.in_proj_weight.split([d_model, 2 * d_model])
+        b_q, b_kv = self.multihead_attn.in_proj_bias.split([d_model, 2 * d_model])
+        k, v = F.linear(mem, w_kv, b_kv).chunk(2, dim=-1)
+        # token i is a single query over its memory column mem[:, :, i], fold the tokens into the batch dim
+        # q: [B, N, d_model] -> [B * N, n_head, 1, d_head]
+        # k/v: [B, S, N, d_model] -> [B * N, n_head, S, d_head]
+        q = F.linear(x, w_q, b_q).view(n_batch * n_token, self.n_head, 1, d_head)
+        k = k.view(n_batch, n_key, n_token, self.n_head, d_head) \
+            .permute(0, 2, 3, 1, 4).reshape(n_batch * n_token, self.n_head, n_key, d_head)
+        v = v.view(n_batch, n_key, n_token, self.n_head, d_head) \
+            .permute(0, 2, 3, 1, 4).reshape(n_batch * n_token, self.n_head, n_key, d_head)
+
+        # masks follow nn.MultiheadAttention (True = ignored), sdpa expects True = attended
+        mask = None
+        if attn_mask is not None:
+            mask = ~attn_mask.view(1, n_token, n_key)
+        if key_padding_mask is not None:
+            kpm = ~key_padding_mask.view(n_batch, 1, n_key)
+            mask = kpm if mask is None else mask & kpm
+        if mask is not None:
+            mask = mask.expand(n_batch, n_token, n_key).reshape(n_batch * n_token, 1, 1, n_key)
+
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=mask,
+                                           dropout_p=self.dropout_p if self.training else 0.0)
+        x = x.reshape(n_batch, n_token, d_model)
+        x = self.multihead_attn.out_proj(x)
         return self.dropout2(x), None
 
     # feed forward block
@@ -240,7 +289,8 @@ class RelaFusionNet(nn.Module):
                  n_head: int = 8,
                  n_layer: int = 6,
                  dropout: float = 0.1,
-                 update_edge: bool = True):
+                 update_edge: bool = True,
+                 use_compile: bool = False):
         super(RelaFusionNet, self).__init__()
         self.device = device
 
@@ -253,14 +303,15 @@ class RelaFusionNet(nn.Module):
                                           d_ffn=d_model * 2,
                                           n_head=n_head,
                                           dropout=dropout,
-                                          update_edge=need_update_edge))
+                                          update_edge=need_update_edge,
+                                          use_compile=use_compile))
         self.fusion = nn.ModuleList(fusion)
 
     def forward(self, x: Tensor, edge: Tensor, edge_mask: Tensor) -> Tensor:
         '''
-            x: (N, d_model)
-            edge: (d_model, N, N)
-            edge_mask: (N, N)
+            x: (B, N, d_model)
+            edge: (B, N, N, d_edge)
+            edge_mask: (B, N), True for padded tokens
         '''
         # attn_multilayer = []
         for mod in self.fusion:
@@ -274,6 +325,7 @@ class FusionNet(nn.Module):
         self.device = device
 
         self.d_embed = config['d_embed']
+        self.d_rpe_in = config['d_rpe_in']
         self.d_rpe = config['d_rpe']
         self.d_model = config['d_embed']
         dropout = config['dropout']
@@ -301,7 +353,8 @@ class FusionNet(nn.Module):
                                         n_head=config['n_scene_head'],
                                         n_layer=config['n_scene_layer'],
                                         dropout=dropout,
-                                        update_edge=update_edge)
+                                        update_edge=update_edge,
+                                        use_compile=config['use_compile'])
 
     def forward(self,
                 actors: Tensor,
@@ -313,30 +366,45 @@ class FusionNet(nn.Module):
         actors = self.proj_actor(actors)
         lanes = self.proj_lane(lanes)
 
-        actors_new, lanes_new, cls_new = list(), list(), list()
-
-        for a_idcs, l_idcs, rpes in zip(actor_idcs, lane_idcs, rpe_prep):
-            # * fusion - scene
-            _actors = actors[a_idcs]
-            _lanes = lanes[l_idcs]
-            tokens = torch.cat([_actors, _lanes], dim=0)
-            cls_token = torch.zeros((1, self.d_model), device=self.device)
-            tokens_with_cls = torch.cat([tokens, cls_token], dim=0)
-
-            rpe = self.proj_rpe_scene(rpes['scene'].permute(1, 2, 0))
-            rpe_with_cls = torch.zeros(
-                (tokens_with_cls.shape[0], tokens_with_cls.shape[0], self.d_rpe),
-                device=self.device)
-            rpe_with_cls[:tokens.shape[0], :tokens.shape[0], :] = rpe
-
-            out, _ = self.fuse_scene(tokens_with_cls, rpe_with_cls, edge_mask=None)
-
-            actors_new.append(out[:len(a_idcs)])
-            lanes_new.append(out[len(a_idcs):-1])
-            cls_new.append(out[-1].unsqueeze(0))
-        actors = torch.cat(actors_new, dim=0)
-        lanes = torch.cat(lanes_new, dim=0)
-        cls = torch.cat(cls_new, dim=0)
+        # * fusion - all scenes in one batch, padded to the longest scene
+        # token layout of each scene: [actors, lanes, cls, padding], the cls token stays zero
+        n_actors = [len(a_idcs) for a_idcs in actor_idcs]
+        n_lanes = [len(l_idcs) for l_idcs in lane_idcs]
+        n_ctx = [n_a + n_l for n_a, n_l in zip(n_actors, n_lanes)]
+        n_batch, n_token = len(n_ctx), max(n_ctx) + 1
+
+        pos = torch.arange(n_token, device=self.device).unsqueeze(0)
+        n_actors_t = torch.tensor(n_actors, device=self.device).unsqueeze(1)
+        n_ctx_t = torch.tensor(n_ctx, device=self.device).unsqueeze(1)
+        is_actor = pos < n_actors_t  # (B, N)
+        is_ctx = pos < n_ctx_t  # (B, N), actor/lane tokens
+        is_lane = is_ctx & ~is_actor  # (B, N)
+        pad_mask = pos > n_ctx_t  # (B, N), padding after the cls token
+
+        # scatter the actors/lanes of all scenes at once, the cls token is the zero slot after the lanes
+        tokens = actors.new_zeros((n_batch, n_token, self.d_model))
+        tokens[is_actor] = actors[torch.cat(actor_idcs)]
+        tokens[is_lane] = lanes[torch.cat(lane_idcs)]
+
+        # (C, N, N) -> (N, N, C) is a view, the transpose is done by the copy into the padded batch
+        rpe = torch.zeros((n_batch, n_token, n_token, self.d_rpe_in), device=self.device)
+        for i, rpes in enumerate(rpe_prep):
+            rpe[i, :n_ctx[i], :n_ctx[i]] = rpes['scene'].permute(1, 2, 0)
+
+        # rpe of the cls token (and of padding) is zero, zeroed in place before the (inplace) relu so that no
+        # second (B, N, N, d_rpe) tensor is allocated, LayerNorm does not keep its output for backward
+        rpe = self.proj_rpe_scene[:2](rpe)
+        rpe.masked_fill_(~(is_ctx.unsqueeze(1) & is_ctx.unsqueeze(2)).unsqueeze(-1), 0.0)
+        rpe = self.proj_rpe_scene[2:](rpe)
+
+        if min(n_ctx) == max(n_ctx):
+            pad_mask = None  # nothing to mask, let sdpa run without a mask
+        out, _ = self.fuse_scene(tokens, rpe, edge_mask=pad_mask)
+
+        # gather back in the flat scene-by-scene order of the inputs
+        actors = out[is_actor]
+        lanes = out[is_lane]
+        cls = out[torch.arange(n_batch, device=self.device), n_ctx_t.squeeze(1)]
         return actors, lanes, cls
 
 
@@ -375,9 +443,10 @@ class SceneDecoder(nn.Module):
         )
 
         # several layers of transformer encoder
+        # batch_first enables the fused encoder-layer fast path at inference, attention runs on sdpa either way
         enc_layer = TransformerEncoderLayer(d_model=self.hidden_size,
-                                            nhead=4, dim_feedforward=self.hidden_size * 12)
-        self.ctx_sat = TransformerEncoder(enc_layer, num_layers=2, enable_nested_tensor=False)
+                                            nhead=4, dim_feedforward=self.hidden_size * 12, batch_first=True)
+        self.ctx_sat = TransformerEncoder(enc_layer, num_layers=2)
 
         # linear projection for rpe embedding rpe_dim = 11
         self.proj_rpe = nn.Sequential(
@@ -407,8 +476,14 @@ class SceneDecoder(nn.Module):
 
         if self.param_out == 'bezier':
             self.N_ORDER = 7
-            self.mat_T = self._get_T_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
-            self.mat_Tp = self._get_Tp_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
+            # matrices are built in fp64 and cast once when registered
+            mat_T = self._get_T_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps)
+            mat_Tp = self._get_Tp_matrix_bezier(n_order=self.N_ORDER, n_step=future_steps)
+            # mat_Tp @ diff(param) / (future_steps * 0.1) folded into a single matrix
+            mat_Tp_diff = torch.matmul(mat_Tp, self._get_diff_matrix(self.N_ORDER)) / (future_steps * 0.1)
+            self.register_buffer('mat_T', mat_T.float(), persistent=False)
+            self.register_buffer('mat_Tp', mat_Tp.float(), persistent=False)
+            self.register_buffer('mat_Tp_diff', mat_Tp_diff.float(), persistent=False)
 
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
@@ -421,8 +496,14 @@ class SceneDecoder(nn.Module):
             )
         elif self.param_out == 'monomial':
             self.N_ORDER = 7
-            self.mat_T = self._get_T_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
-            self.mat_Tp = self._get_Tp_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps).to(self.device)
+            # matrices are built in fp64 and cast once when registered
+            mat_T = self._get_T_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps)
+            mat_Tp = self._get_Tp_matrix_monomial(n_order=self.N_ORDER, n_step=future_steps)
+            # mat_Tp @ diff(param) / (future_steps * 0.1) folded into a single matrix
+            mat_Tp_diff = torch.matmul(mat_Tp, self._get_diff_matrix(self.N_ORDER)) / (future_steps * 0.1)
+            self.register_buffer('mat_T', mat_T.float(), persistent=False)
+            self.register_buffer('mat_Tp', mat_Tp.float(), persistent=False)
+            self.register_buffer('mat_Tp_diff', mat_Tp_diff.float(), persistent=False)
 
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
@@ -434,6 +515,10 @@ class SceneDecoder(nn.Module):
                 nn.Linear(self.hidden_size, (self.N_ORDER + 1) * 5)
             )
         elif self.param_out == 'none':
+            # torch.gradient(x, dim=-2)[0] / 0.1 as a fixed matrix
+            self.register_buffer('grad_mat', self._get_grad_matrix(n_step=future_steps, dt=0.1).float(),
+                                 persistent=False)
+
             self.reg = nn.Sequential(
                 nn.Linear(self.hidden_size, self.hidden_size),
                 nn.LayerNorm(self.hidden_size),
@@ -447,38 +532,42 @@ class SceneDecoder(nn.Module):
             raise NotImplementedError
 
     def _get_T_matrix_bezier(self, n_order, n_step):
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        T = []
-        for i in range(n_order + 1):
-            coeff = math.comb(n_order, i) * (1.0 - ts) ** (n_order - i) * ts ** i
-            T.append(coeff)
-        return torch.Tensor(np.array(T).T)
+        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)[:, None]
+        i = np.arange(n_order + 1)
+        coeff = np.array([math.comb(n_order, k) for k in i])
+        return torch.from_numpy(coeff * (1.0 - ts) ** (n_order - i) * ts ** i)
 
     def _get_Tp_matrix_bezier(self, n_order, n_step):
         # ~ 1st derivatives
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        Tp = []
-        for i in range(n_order):
-            coeff = n_order * math.comb(n_order - 1, i) * (1.0 - ts) ** (n_order - 1 - i) * ts ** i
-            Tp.append(coeff)
-        return torch.Tensor(np.array(Tp).T)
+        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)[:, None]
+        i = np.arange(n_order)
+        coeff = n_order * np.array([math.comb(n_order - 1, k) for k in i])
+        return torch.from_numpy(coeff * (1.0 - ts) ** (n_order - 1 - i) * ts ** i)
+
+    def _get_diff_matrix(self, n_order):
+        # D @ param == torch.diff(param, dim=-2)
+        return torch.from_numpy(np.eye(n_order, n_order + 1, k=1) - np.eye(n_order, n_order + 1))
+
+    def _get_grad_matrix(self, n_step, dt):
+        # central differences inside, one-sided at both ends (as torch.gradient with edge_order=1)
+        G = np.zeros((n_step, n_step))
+        idx = np.arange(1, n_step - 1)
+        G[idx, idx - 1] = -0.5
+        G[idx, idx + 1] = 0.5
+        G[0, :2] = [-1.0, 1.0]
+        G[-1, -2:] = [-1.0, 1.0]
+        return torch.from_numpy(G / dt)
 
     def _get_T_matrix_monomial(self, n_order, n_step):
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        T = []
-        for i in range(n_order + 1):
-            coeff = ts ** i
-            T.append(coeff)
-        return torch.Tensor(np.array(T).T)
+        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)[:, None]
+        i = np.arange(n_order + 1)
+        return torch.from_numpy(ts ** i)
 
     def _get_Tp_matrix_monomial(self, n_order, n_step):
         # ~ 1st derivatives
-        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)
-        Tp = []
-        for i in range(n_order):
-            coeff = (i + 1) * (ts ** i)
-            Tp.append(coeff)
-        return torch.Tensor(np.array(Tp).T)
+        ts = np.linspace(0.0, 1.0, n_step, endpoint=True)[:, None]
+        i = np.arange(n_order)
+        return torch.from_numpy((i + 1) * ts ** i)
 
     def forward(self,
                 ctx: torch.Tensor,
@@ -486,44 +575,44 @@ class SceneDecoder(nn.Module):
                 actor_idcs: List[Tensor],
                 tgt_feat: torch.Tensor,
                 tgt_rpes: torch.Tensor):
-        res_cls, res_reg, res_aux = [], [], []
-
         tgt_rpes = self.proj_rpe(tgt_rpes)  # [n_av, 128]
-        if len(tgt_feat.shape) == 1:
-            tgt_feat = tgt_feat.unsqueeze(0)
 
         tgt = self.proj_tgt(torch.cat([tgt_feat, tgt_rpes], dim=-1))
 
-        for idx, a_idcs in enumerate(actor_idcs):
-            _ctx = ctx[idx].unsqueeze(0)
-            _actors = actors[a_idcs]
-
-            cls_embed = self.ctx_proj(_ctx).view(-1, self.num_modes, self.hidden_size).permute(1, 0, 2)
-            cls_embed = self.ctx_sat(cls_embed)
-
-            actor_embed = self.actor_proj(_actors).view(-1, self.num_modes, self.hidden_size).permute(1, 0, 2)
+        # * decode all scenes at once, the actors of each scene are consecutive along the actor dim
+        n_actors = [len(a_idcs) for a_idcs in actor_idcs]
+        scene_idcs = torch.arange(len(n_actors), device=ctx.device).repeat_interleave(
+            torch.tensor(n_actors, device=ctx.device))  # scene of each actor
+        actors = actors[torch.cat(actor_idcs)]
 
-            tgt_embed = torch.zeros_like(actor_embed)
+        cls_embed = self.ctx_proj(ctx).view(-1, self.num_modes, self.hidden_size)  # [B, M, d]
+        cls_embed = self.ctx_sat(cls_embed)
+        cls = self.cls(cls_embed).view(-1, self.num_modes)  # [B, M]
+        cls_embed = cls_embed.permute(1, 0, 2)  # [M, B, d]
 
-            tgt_embed[0] = tgt[idx].unsqueeze(0)
+        actor_embed = self.actor_proj(actors).view(-1, self.num_modes, self.hidden_size).permute(1, 0, 2)
 
-            embed = cls_embed + actor_embed + tgt_embed
+        # the target embedding only goes to the first mode
+        embed = cls_embed[:, scene_idcs] + actor_embed
+        embed[0] += tgt[scene_idcs]
 
-            cls = self.cls(cls_embed).view(self.num_modes, -1)
+        param = self.reg(embed).float()
 
+        # keep the trajectory parameterization in fp32 under autocast, bf16 is too coarse for positions
+        with torch.autocast(device_type=param.device.type, enabled=False):
             if self.param_out == 'bezier':
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
+                param = param.view(self.num_modes, -1, self.N_ORDER + 1, 5)
                 reg_param = param[..., :2]
                 reg_param = reg_param.permute(1, 0, 2, 3)
                 reg = torch.matmul(self.mat_T, reg_param)
-                vel = torch.matmul(self.mat_Tp, torch.diff(reg_param, dim=2)) / (self.future_steps * 0.1)
+                vel = torch.matmul(self.mat_Tp_diff, reg_param)
                 cov_param = param[..., 2:]
                 cov_param = cov_param.permute(1, 0, 2, 3)
                 cov = torch.matmul(self.mat_T, cov_param)
-                cov_vel = torch.matmul(self.mat_Tp, torch.diff(cov_param, dim=2)) / (self.future_steps * 0.1)
+                cov_vel = torch.matmul(self.mat_Tp_diff, cov_param)
 
             elif self.param_out == 'monomial':
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
+                param = param.view(self.num_modes, -1, self.N_ORDER + 1, 5)
                 reg_param = param[..., :2]
                 reg_param = reg_param.permute(1, 0, 2, 3)
                 reg = torch.matmul(self.mat_T, reg_param)
@@ -531,27 +620,31 @@ class SceneDecoder(nn.Module):
                 cov_param = param[..., 2:]
                 cov_param = cov_param.permute(1, 0, 2, 3)
                 cov = torch.matmul(self.mat_T, cov_param)
-                cov_vel = torch.matmul(self.mat_Tp, torch.diff(cov_param, dim=2)) / (self.future_steps * 0.1)
+                cov_vel = torch.matmul(self.mat_Tp_diff, cov_param)
 
             elif self.param_out == 'none':
-                param = self.reg(embed).view(self.num_modes, -1, self.N_ORDER + 1, 5)
+                param = param.view(self.num_modes, -1, self.future_steps, 5)
                 reg = param[..., :2]
                 reg = reg.permute(1, 0, 2, 3)
-                vel = torch.gradient(reg, dim=-2)[0] / 0.1
+                vel = torch.matmul(self.grad_mat, reg)
                 cov = param[..., 2:]
                 cov = cov.permute(1, 0, 2, 3)
-                cov_vel = torch.gradient(cov, dim=-2)[0] / 0.1
+                cov_vel = torch.matmul(self.grad_mat, cov)
 
             reg = torch.cat([reg, torch.exp(cov)], dim=-1)
 
-            cls = cls.permute(1, 0)
-            cls = F.softmax(cls * 1.0, dim=1)
-            res_cls.append(cls)
-            res_reg.append(reg)
-            if self.param_out == 'none':
-                res_aux.append((vel, cov_vel, None))  # ! None is a placeholder
-            else:
-                res_aux.append((vel, cov_vel, param))
+        cls = F.softmax(cls, dim=1)
+
+        # * split back into per-scene results
+        res_cls = list(cls.split(1, dim=0))
+        res_reg = list(reg.split(n_actors, dim=0))
+        if self.param_out == 'none':
+            res_aux = [(_vel, _cov_vel, None)  # ! None is a placeholder
+                       for _vel, _cov_vel in zip(vel.split(n_actors, dim=0), cov_vel.split(n_actors, dim=0))]
+        else:
+            res_aux = list(zip(vel.split(n_actors, dim=0),
+                               cov_vel.split(n_actors, dim=0),
+                               param.split(n_actors, dim=1)))
 
         return res_cls, res_reg, res_aux
 
@@ -561,6 +654,12 @@ class ScenePredNet(nn.Module):
     def __init__(self, cfg, device):
         super(ScenePredNet, self).__init__()
         self.device = device
+        self.use_amp = cfg['use_amp']
+
+        if self.use_amp:
+            # fp32 matmuls left outside of bf16 autocast may use TF32 tensor cores
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
 
         self.actor_net = ActorNet(n_in=cfg['in_actor'],
                                   hidden_size=cfg['d_actor'],
@@ -579,26 +678,34 @@ class ScenePredNet(nn.Module):
                                        future_steps=cfg['g_pred_len'],
                                        num_modes=cfg['g_num_modes'])
 
+        if cfg['use_compile']:
+            # compile forward in place so that the state_dict keys stay unchanged, actor/lane counts vary per batch
+            for mod in [self.actor_net, self.lane_net,
+                        self.pred_scene.actor_proj, self.pred_scene.ctx_proj, self.pred_scene.proj_tgt,
+                        self.pred_scene.cls, self.pred_scene.reg]:
+                mod.forward = torch.compile(mod.forward, dynamic=True)
+
     def forward(self, data):
         actors, actor_idcs, lanes, lane_idcs, rpe, tgt_nodes, tgt_rpe = data
 
-        # * actors/lanes encoding
-        actors = self.actor_net(actors)  # output: [N_{actor}, 128]
-        lanes = self.lane_net(lanes)  # output: [N_{lane}, 128]
-        # tgt encode
-        tgt_feat = self.lane_net(tgt_nodes)  # output: [1, 128]
-        # * fusion
-        actors, lanes, cls = self.fusion_net(actors, actor_idcs, lanes, lane_idcs, rpe)
-        # * decoding
-        out = self.pred_scene(cls, actors, actor_idcs, tgt_feat, tgt_rpe)
+        with torch.autocast(device_type=actors.device.type, dtype=torch.bfloat16, enabled=self.use_amp):
+            # * actors/lanes encoding
+            actors = self.actor_net(actors)  # output: [N_{actor}, 128]
+            lanes = self.lane_net(lanes)  # output: [N_{lane}, 128]
+            # tgt encode
+            tgt_feat = self.lane_net(tgt_nodes)  # output: [1, 128]
+            # * fusion
+            actors, lanes, cls = self.fusion_net(actors, actor_idcs, lanes, lane_idcs, rpe)
+            # * decoding
+            out = self.pred_scene(cls, actors, actor_idcs, tgt_feat, tgt_rpe)
 
         return out
 
     def pre_process(self, data):
         actors = gpu(data['ACTORS'], self.device)
-        actor_idcs = gpu(data['ACTOR_IDCS'], self.device)
+        actor_idcs = gpu_cat(data['ACTOR_IDCS'], self.device)  # one copy instead of one per scene
         lanes = gpu(data['LANES'], self.device)
-        lane_idcs = gpu(data['LANE_IDCS'], self.device)
+        lane_idcs = gpu_cat(data['LANE_IDCS'], self.device)
         rpe = gpu(data['RPE'], self.device)
         tgt_nodes = gpu(data['TGT_NODES'], self.device)
         tgt_rpe = gpu(data['TGT_RPE'], self.device)
@@ -20,6 +20,17 @@ def gpu(data, device):
     return data
 
 
+def gpu_cat(data, device):
+    """
+    Transfer a list of tensors to gpu with a single copy
+    Returns views of the transferred buffer, split along dim 0 as in `data`
+    """
+    buf = torch.cat(data, dim=0)
+    if buf.device.type == 'cpu' and torch.device(device).type == 'cuda':
+        buf = buf.pin_memory()  # non_blocking only overlaps for page-locked memory
+    return list(buf.to(device, non_blocking=True).split([len(x) for x in data]))
+
+
 
 def from_numpy(data):
     """Recursively transform numpy.ndarray to torch.Tensor.